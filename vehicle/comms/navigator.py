@@ -2,16 +2,30 @@ import os
 import sys
 import logging 
 import time
+from operator import attrgetter
+from threading import Thread, Event
 from comms.mavactive import mavactive, mavlink, mavutil
 
 ''' Navigator connection '''
 MAVLINK_URL = os.getenv('MAVLINK_URL', 'tcp:127.0.0.1:5777')
 logger = logging.getLogger(__name__)
 
+# RC override defaults (65535 = ignore) and default channel mapping names
+_DEFAULT_RC = (65535,) * 18
+_NAMED_INDEX = {
+    'pitch': 0, 'roll': 1, 'throttle': 2, 'yaw': 3, 'forward': 4,
+    'lateral': 5, 'camera_pan': 6, 'camera_tilt': 7, 'lights1': 8,
+    'lights2': 9, 'video_switch': 10
+}
+_RCIN_INDEX = {f'rcin{i+1}': i for i in range(18)}
+
 class Navigator:
     ''' Navigator connection and operation management'''
     def __init__(self, thrusters=8):
         self.thrusters=thrusters
+        self._servo_attr = attrgetter(*[f'servo{i+1}_raw' for i in range(thrusters)])
+        self._last_manual = None
+        self._latest_servo = None
         logger.info(f'Connection to navigator with: {MAVLINK_URL}')
         try:
             logger.info('Trying to get heartbeat...')
@@ -22,10 +36,53 @@ class Navigator:
             logger.error(f'Error in connecting to Navigator: {e}')
             sys.exit(1)
 
+        self._tgt_sys = self.navigator_board.target_system
+        self._tgt_comp = self.navigator_board.target_component
+        self._mav = self.navigator_board.mav
+        self._rc_rest = _DEFAULT_RC[6:]
+        self._clear_motion_msg = self._mav.rc_channels_override_encode(
+            self._tgt_sys, self._tgt_comp, *[1500]*6, *self._rc_rest
+        )
+        self._mode_map = self.navigator_board.mode_mapping()
+        self.navigator_board.message_hooks.append(self._on_msg)
+        self._stop_reading = Event()
+        self.reader_thread = Thread(target=self._recv_loop, daemon=True)
+        self.reader_thread.start()
         self.heart = mavactive(self.navigator_board, mavlink.MAV_TYPE_GCS)
         self.disarm()
         self.change_mode('MANUAL')
 
+    def _on_msg(self, conn, msg):
+        ''' Message hook: keeps the latest servo outputs '''
+        if msg.get_type() == 'SERVO_OUTPUT_RAW':
+            self._latest_servo = msg
+
+    def _recv_loop(self):
+        ''' Reads the mavlink stream so message hooks (and pymavlink's own
+        armed/mode tracking) stay up to date. Messages are dropped here.
+        '''
+        while not self._stop_reading.is_set():
+            try:
+                self.navigator_board.recv_match(blocking=True, timeout=0.5)
+            except Exception:
+                # message hooks run on this thread too: log and keep reading
+                # so the cached armed/mode state never silently freezes
+                if self._stop_reading.is_set():
+                    return
+                logger.error('Error reading from Navigator', exc_info=True)
+                time.sleep(0.5)
+
+    def _wait_armed(self, armed, timeout=5.0, period=0.05):
+        ''' Waits until the reader thread sees the requested armed state.
+        Raises TimeoutError if the autopilot has not got there in 'timeout'
+        seconds (e.g. arming refused by a pre-arm check).
+        '''
+        deadline = time.monotonic() + timeout
+        while bool(self.navigator_board.motors_armed()) != armed:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'Timed out waiting for motors to {"arm" if armed else "disarm"}')
+            time.sleep(period)
+
     def status(self):
         armed = bool(self.navigator_board.motors_armed())
         mode = self.navigator_board.flightmode
@@ -49,43 +106,40 @@ class Navigator:
         ''' Set up thrusters (necessary for any movement) '''
         logger.info('Arming motors...')
         self.navigator_board.arducopter_arm()
-        self.navigator_board.motors_armed_wait()
+        self._wait_armed(True)
         logger.info('MOTORS ARMED')
 
     def disarm(self):
-        ''' Turn off thrusters '''
+        ''' Turn off thrusters.
+        Raises TimeoutError if the autopilot does not disarm: the vehicle is
+        then still armed, so callers must stop sending motion themselves.
+        '''
         logger.info('Disarming motors...')
         self.navigator_board.arducopter_disarm()
-        self.navigator_board.motors_disarmed_wait()
+        self._wait_armed(False)
         logger.info('MOTORS DISARMED')
 
     def change_mode(self, mode):
-        mode = mode.upper()
         ''' Sets autopilot mode by id '''
-        if mode not in self.navigator_board.mode_mapping():
-            logger.error('Unknown mode')
-            sys.exit(1)
+        mode_id = self._mode_map.get(mode.upper())
+        if mode_id is None:
+            logger.error(f'Unknown mode: {mode}')
+            return
 
-        mode_id = self.navigator_board.mode_mapping()[mode]
         self.navigator_board.set_mode(mode_id)
 
     # pitch/forward, roll/lateral, throttle, yaw
     def drive_manual(self, x, y, z, r, buttons):
-        logger.info(f'Pitch/Forward: {x}, Roll/Lateral: {y}, Throttle: {z}, Yaw: {r}')
-        self.navigator_board.mav.manual_control_send(
-            self.navigator_board.target_system, 
-            x, y, z, r, buttons
-        )
-
-    def send_rc(self, rcin1=65535, rcin2=65535, rcin3=65535, rcin4=65535,
-                rcin5=65535, rcin6=65535, rcin7=65535, rcin8=65535,
-                rcin9=65535, rcin10=65535, rcin11=65535, rcin12=65535,
-                rcin13=65535, rcin14=65535, rcin15=65535, rcin16=65535,
-                rcin17=65535, rcin18=65535, *, # keyword-only from here
-                pitch=None, roll=None, throttle=None, yaw=None, forward=None,
-                lateral=None, camera_pan=None, camera_tilt=None, lights1=None,
-                lights2=None, video_switch=None):
-        
+        logger.debug('Pitch/Forward: %s, Roll/Lateral: %s, Throttle: %s, Yaw: %s', x, y, z, r)
+        inputs = (x, y, z, r, buttons)
+        if self._last_manual is None or self._last_manual[0] != inputs:
+            msg = self._mav.manual_control_encode(self._tgt_sys, x, y, z, r, buttons)
+            self._last_manual = (inputs, msg)
+        # Repeated input reuses the encoded message; send() still re-packs it
+        # with the current sequence number and advances it
+        self._mav.send(self._last_manual[1])
+
+    def send_rc(self, *rcin, **channels):
         ''' Sets all 18 rc channels as specified.
         Values should be between 1100-1900, or left as 65535 to ignore.
         Can specify values:
@@ -98,50 +152,67 @@ class Navigator:
           or rcinX specifiers.
         '''
 
-        rc_channel_values = (
-            pitch        or rcin1,
-            roll         or rcin2,
-            throttle     or rcin3,
-            yaw          or rcin4,
-            forward      or rcin5,
-            lateral      or rcin6,
-            camera_pan   or rcin7,
-            camera_tilt  or rcin8,
-            lights1      or rcin9,
-            lights2      or rcin10,
-            video_switch or rcin11,
-            rcin12, rcin13, rcin14, rcin15, rcin16, rcin17, rcin18
-        )
-        logger.info(f'Enabling motion through RC channels')
-        logger.info(rc_channel_values)
-        self.navigator_board.mav.rc_channels_override_send(
-            self.navigator_board.target_system,
-            self.navigator_board.target_component,
+        rc_channel_values = list(_DEFAULT_RC)
+        rc_channel_values[:len(rcin)] = rcin
+        named = {}
+        for name, value in channels.items():
+            if name in _RCIN_INDEX:
+                rc_channel_values[_RCIN_INDEX[name]] = value
+            elif name in _NAMED_INDEX:
+                named[name] = value
+            else:
+                raise TypeError(f'send_rc() got an unexpected keyword argument {name!r}')
+
+        for name, value in named.items():
+            if value is not None:
+                rc_channel_values[_NAMED_INDEX[name]] = value
+
+        logger.debug('Enabling motion through RC channels: %s', rc_channel_values)
+        self._mav.rc_channels_override_send(
+            self._tgt_sys, self._tgt_comp,
             *rc_channel_values
         )
 
+    def send_motion_rc(self, pitch=65535, roll=65535, throttle=65535, yaw=65535,
+                       forward=65535, lateral=65535):
+        ''' Fast path of send_rc for the 6 motion channels only.
+        The remaining 12 channels are left as 65535 (ignored).
+        '''
+        self._mav.rc_channels_override_send(
+            self._tgt_sys, self._tgt_comp,
+            pitch, roll, throttle, yaw, forward, lateral,
+            *self._rc_rest
+        )
 
     def clear_motion(self, stopped_pwm=1500):
         ''' Set 6 RC motion channels to a stopped value '''
         logger.info('Clearing motion')
-        self.send_rc(*[stopped_pwm]*6)
+        if stopped_pwm == 1500:
+            # encoded once in __init__; send() packs it with the current seq
+            self._mav.send(self._clear_motion_msg)
+            return
+        self.send_motion_rc(*[stopped_pwm]*6)
 
     def get_thruster_outputs(self):
         ''' Returns (and notes) the first 'self.thrusters' servo PWM values.
         Offset by 1500 to make it clear how each thruster is active.
+        Reads the latest SERVO_OUTPUT_RAW seen by the reader thread, so it
+        never blocks (empty list until the first one arrives).
         '''
         logger.debug('get_thruster_outputs')
-        servo_outputs = self.navigator_board.recv_match(type='SERVO_OUTPUT_RAW',
-                                        blocking=True).to_dict()
-        thruster_outputs = [servo_outputs[f'servo{i+1}_raw'] - 1500
-                            for i in range(self.thrusters)]
-        logger.info(f'{thruster_outputs=}')
+        servo_outputs = self._latest_servo
+        if servo_outputs is None:
+            return []
+        thruster_outputs = [raw - 1500 for raw in self._servo_attr(servo_outputs)]
+        logger.debug('thruster_outputs=%s', thruster_outputs)
         return thruster_outputs
     
     def disconnect(self):
         '''Close the mavlink connection'''
         logger.info('Disconnect: Closing mavlink connection')
+        self._stop_reading.set()
         self.navigator_board.close()
+        self.reader_thread.join()
 
     def cleanup(self, *, disconnect=True):
         '''Attemp to disarm and stop sending heartbeats'''
@@ -155,15 +226,23 @@ class Navigator:
             self.disconnect()
 
 # TESTING AS A SCRIPT
+# async def _test(navigator, period=0.1):
+#     loop = asyncio.get_running_loop()
+#     next_send = loop.time()
+#     while True:
+#         navigator.drive_manual(500, -500, 250, 500, 0)
+#         next_send += period
+#         await asyncio.sleep(max(0, next_send - loop.time()))
+
 # if __name__ == '__main__':
+#     import asyncio
+#     import uvloop
 #     navigator = Navigator()
 #     navigator.change_mode('MANUAL')
 #     navigator.arm()
 
 #     try:
-#         while True:
-#             navigator.drive_manual(500, -500, 250, 500, 0)
-#             time.sleep(0.1)
+#         uvloop.run(_test(navigator))
 #     except KeyboardInterrupt:
 #         navigator.clear_motion()
 #         navigator.disarm()
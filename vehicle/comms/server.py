@@ -1,26 +1,101 @@
 import websockets
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 import asyncio
+import socket
 import json
+import orjson
+import fastjsonschema
 from comms.navigator import Navigator
 import logging 
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
 
 navigator = Navigator()
+# pymavlink is not thread-safe: every command sent to the board goes through
+# this single worker so the event loop never blocks on MAVLink I/O
+mav_exec = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mavlink')
 clients = set()
 logger = logging.getLogger(__name__)
 
+@dataclass
+class NavigatorState:
+    ''' Autopilot state cached from the MAVLink stream '''
+    is_armed: bool = False
+    mode: Optional[str] = None
+    thruster_outputs: list = field(default_factory=list)
+
+    def status(self):
+        return {
+            'is_armed': self.is_armed,
+            'mode': self.mode
+        }
+
+state = NavigatorState()
+
 last_motion = {
     "method": None, 
-    "data": None
+    "data": None,
+    "seq": 0
 }
 
-def handle_mode(mode):
-    if mode != navigator.status()['mode']:
+# inbound command schema, compiled once into a plain python validator.
+# Axis ranges depend on drive_method: MANUAL_CONTROL takes -1000..1000,
+# RC overrides take a 1100-1900 PWM value or 65535 (ignore)
+MOTION_AXES = ('pitch', 'roll', 'throttle', 'yaw')
+MANUAL_AXIS = {'type': 'integer', 'minimum': -1000, 'maximum': 1000}
+RC_AXIS = {'type': 'integer', 'anyOf': [{'minimum': 1100, 'maximum': 1900},
+                                        {'const': 65535}]}
+
+validate_command = fastjsonschema.compile({
+    '$schema': 'http://json-schema.org/draft-07/schema#',
+    'type': 'object',
+    'properties': {
+        'arm': {'type': ['integer', 'boolean']},
+        'mode': {'type': 'string'},
+        'drive_method': {'enum': ['manual', 'rc_channels']},
+        **{axis: {'type': 'integer'} for axis in MOTION_AXES},
+        'buttons': {'type': 'integer', 'minimum': 0, 'maximum': 65535}
+    },
+    'additionalProperties': False,
+    'if': {
+        'properties': {'drive_method': {'const': 'rc_channels'}},
+        'required': ['drive_method']
+    },
+    'then': {'properties': {axis: RC_AXIS for axis in MOTION_AXES}},
+    'else': {'properties': {axis: MANUAL_AXIS for axis in MOTION_AXES}}
+})
+
+# unchanged motion is still resent at this interval so MAVLink failsafes stay fed
+MOTION_KEEPALIVE = 0.5
+
+def refresh_state():
+    ''' Re-reads armed/mode from the connection into the cache '''
+    status = navigator.status()
+    state.is_armed = status['is_armed']
+    state.mode = status['mode']
+
+def update_servo_state():
+    state.thruster_outputs = navigator.get_thruster_outputs()
+
+def on_mavlink_message(conn, msg):
+    ''' Message hook, called from the navigator reader thread for every message '''
+    msg_type = msg.get_type()
+    if msg_type == 'HEARTBEAT':
+        refresh_state()
+    elif msg_type == 'SERVO_OUTPUT_RAW':
+        update_servo_state()
+
+# registered after Navigator's own hook, so its latest servo message is current
+navigator.navigator_board.message_hooks.append(on_mavlink_message)
+
+def handle_mode(mode, st):
+    if mode != st['mode']:
         navigator.change_mode(mode)
 
-def handle_arm(arming):
-    is_armed = navigator.status()['is_armed']
+def handle_arm(arming, st):
+    is_armed = st['is_armed']
 
     if arming:
         logger.info('Arm requested')
@@ -40,47 +115,99 @@ def handle_arm(arming):
             return {'armed': False, 'message': 'Vehicle already disarmed'}
         navigator.clear_motion()
         time.sleep(0.1)
-        navigator.disarm()
+        try:
+            navigator.disarm()
+        except Exception as e:
+            logger.error(f'Disarming failed: {e}')
+            return {'armed': True, 'error': 'disarming failed'}
         return {'armed': False, 'message': 'Motors disarmed'}
 
+def _safe_stop():
+    ''' Stops all motion and disarms, in a single trip to the mavlink worker.
+    Never raises: it runs from cleanup paths where the link may be dead.
+    '''
+    try:
+        navigator.clear_motion()
+    except Exception as e:
+        logger.error(f'Clearing motion failed: {e}')
+    try:
+        navigator.disarm()
+    except Exception as e:
+        logger.error(f'Disarming failed: {e}')
+
+def enqueue(queue, message):
+    ''' Queues a message for the client, dropping the oldest one if full '''
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        queue.get_nowait()
+        queue.put_nowait(message)
+
+async def relay(websocket, queue):
+    ''' Sends queued messages, merging pending ones into a single frame '''
+    while True:
+        message = await queue.get()
+        batch = [message]
+        while not queue.empty() and len(batch) < 16:
+            batch.append(queue.get_nowait())
+        try:
+            await websocket.send(orjson.dumps(batch if len(batch) > 1 else message))
+        except (ConnectionClosedOK, ConnectionClosedError):
+            return
+
 async def echo(websocket):
     clients.add(websocket)
-    is_control_client = True 
+    websocket.out_queue = asyncio.Queue(maxsize=32)
+    relay_task = asyncio.create_task(relay(websocket, websocket.out_queue))
+    loop = asyncio.get_running_loop()
     try:
         async for message in websocket:
             try:
-                commands = json.loads(message)
-                logger.info(commands)
+                commands = orjson.loads(message)
+                logger.debug('Command: %s', commands)
+                validate_command(commands)
+                st = state.status()
                 drive_method = None
                 arm_result = None
 
                 if 'arm' in commands:
-                    arm_result = handle_arm(commands['arm'])
+                    arm_result = await loop.run_in_executor(mav_exec, handle_arm, commands['arm'], st)
+                    refresh_state()
 
                 if 'mode' in commands:
-                    handle_mode(commands['mode'])
+                    await loop.run_in_executor(mav_exec, handle_mode, commands['mode'], st)
+                    refresh_state()
 
                 if 'drive_method' in commands:
                     drive_method = commands['drive_method']
-                    last_motion['method'] = drive_method
-                    last_motion['data'] = commands
+                    # clients stream the same command at 10-20Hz: only a new
+                    # payload counts as a change for motion_loop
+                    if commands != last_motion['data']:
+                        last_motion['method'] = drive_method
+                        last_motion['data'] = commands
+                        last_motion['seq'] += 1
                 
                 status = {
                     "message_received": True,
                     "arm_result": arm_result,
-                    "navigator_status": navigator.status(),
-                    "thrusters_value": navigator.get_thruster_outputs()
+                    "navigator_status": state.status(),
+                    "thrusters_value": state.thruster_outputs
                 }
 
-                await websocket.send(json.dumps(status))
+                enqueue(websocket.out_queue, status)
             
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError
             except json.JSONDecodeError as e:
                 logger.error(f'Invalid JSON: {e}')
-                await websocket.send(json.dumps({"error": "Invalid JSON"}))
+                enqueue(websocket.out_queue, {"error": "Invalid JSON"})
+
+            except fastjsonschema.JsonSchemaValueException as e:
+                logger.error(f'Invalid command: {e.message}')
+                enqueue(websocket.out_queue, {"error": "Invalid command", "detail": e.message})
 
             except KeyError as e:
                 logger.error(f'Missing field: {e}')
-                await websocket.send(json.dumps({"error": f"Missing field: {e}"}))
+                enqueue(websocket.out_queue, {"error": f"Missing field: {e}"})
 
     except (ConnectionClosedOK, ConnectionClosedError) as e:
         logger.info(f'Client disconnected: {e}')
@@ -89,32 +216,52 @@ async def echo(websocket):
         logger.info(f'Error in echo(): {e}')
     
     finally:
+        relay_task.cancel()
         clients.discard(websocket)
-        if is_control_client and not clients:
+        if not clients:
             logger.info('Last control client left: disarming')
-            navigator.clear_motion()
-            navigator.disarm()
+            # forget the last command first: motion_loop stops right away (even
+            # if the disarm fails) and a later re-arm does not replay it
+            last_motion['method'] = last_motion['data'] = None
+            await loop.run_in_executor(mav_exec, _safe_stop)
 
 async def motion_loop():
+    loop = asyncio.get_running_loop()
+    last_sent_seq = None
+    last_sent_time = 0.0
     while True:
-        if navigator.status()['is_armed'] and last_motion["method"]:
+        now = time.monotonic()
+        # only drive while an operator is connected
+        if (clients and state.is_armed and last_motion["method"] and
+                (last_motion["seq"] != last_sent_seq or
+                 now - last_sent_time >= MOTION_KEEPALIVE)):
             d = last_motion["data"]
+            last_sent_seq = last_motion["seq"]
+            last_sent_time = now
 
-            if last_motion["method"] == "manual":
-                navigator.drive_manual(
-                    d.get("pitch", 0),
-                    d.get("roll", 0),
-                    d.get("throttle", 0),
-                    d.get("yaw", 0),
-                    d.get("buttons", 0),
-                )
-            elif last_motion["method"] == "rc_channels":
-                navigator.send_rc(
-                    d.get("pitch", 665535),
-                    d.get("roll", 665535),
-                    d.get("throttle", 665535),
-                    d.get("yaw", 665535),
-                )
+            # a bad frame must not kill the loop and stop all later motion
+            try:
+                if last_motion["method"] == "manual":
+                    await loop.run_in_executor(
+                        mav_exec,
+                        navigator.drive_manual,
+                        int(d.get("pitch", 0)),
+                        int(d.get("roll", 0)),
+                        int(d.get("throttle", 0)),
+                        int(d.get("yaw", 0)),
+                        int(d.get("buttons", 0)),
+                    )
+                elif last_motion["method"] == "rc_channels":
+                    await loop.run_in_executor(
+                        mav_exec,
+                        navigator.send_motion_rc,
+                        int(d.get("pitch", 65535)),
+                        int(d.get("roll", 65535)),
+                        int(d.get("throttle", 65535)),
+                        int(d.get("yaw", 65535)),
+                    )
+            except Exception:
+                logger.error('Error sending motion', exc_info=True)
 
         await asyncio.sleep(0.05)  
 
@@ -124,15 +271,34 @@ def run():
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info('Server shutdown')
-        navigator.clear_motion()
-        navigator.disarm()
+        _safe_stop()
+
+def server_socket(host, port, buffer_size=2 << 20):
+    ''' Listening socket tuned for small, latency sensitive frames.
+    Accepted connections inherit these options.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    sock.bind((host, port))
+    return sock
 
 async def main():
+    refresh_state()
     asyncio.create_task(motion_loop())
-    async with websockets.serve(echo, '0.0.0.0', 55000, process_request=lambda *args, **kwargs: None):
+    # commands and status frames are tiny: cap frames at 16 KiB
+    async with websockets.serve(echo, sock=server_socket('0.0.0.0', 55000),
+                                max_size=2**14,
+                                process_request=lambda *args, **kwargs: None):
         logger.info('WebSocket server started on port 55000. Waiting for commands')
         await asyncio.Future() 
 
+# Status frames are sent as binary (orjson bytes), which skips the UTF-8
+# validation text frames go through. Clients should send commands as binary
+# frames too (e.g. the JSON string encoded to UTF-8 bytes); text frames are
+# still accepted since orjson.loads takes both str and bytes.
 # package example:
 # {'drive_method': 'manual', 'mode': 'MANUAL', 'pitch': 500, 'roll': 0, 'throttle': 0, 'yaw': 0, 'buttons': 0}
 # {"arm": 1, "drive_method": "manual", "mode": "MANUAL", "pitch": 500, "roll": 0, "throttle": 0, "yaw": 0, "buttons": 0}
\ No newline at end of file
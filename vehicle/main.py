@@ -1,6 +1,8 @@
+import uvloop
 from config.logging import setup_logging
 from comms.server import run as websocket_server
 
+uvloop.install()
 setup_logging()
 
 #main 